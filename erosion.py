@@ -12,6 +12,7 @@ import random
 from time import sleep
 
 import numpy as np
+from numba import get_num_threads, njit, prange
 from opensimplex import OpenSimplex
 import pygame
 
@@ -20,6 +21,7 @@ SEDIMENTATION_STRENGTH = .1
 DROP_CAPAC = 1
 STEEPNESS_COEFF = 1
 MAX_SED_PER_TILE = 1
+DIAGONAL_COST = 1.4
 
 class Console:
 	#A basic graphical ASCII output emulator
@@ -34,6 +36,10 @@ class Console:
 		self.y = y
 		self.scale = scale
 		self.screen = pygame.display.set_mode(self.size)
+		#rendered glyphs, keyed by (char, fore)
+		self.glyph_cache = {}
+		#whether characters have a usable amount of ink, keyed by codepoint
+		self.valid_char_cache = {}
 	#helpers and debugging
 	def test(self):
 		for i in range(self.y):
@@ -43,15 +49,14 @@ class Console:
 		self.render()
 	def get_percent_on(self, unicode_value):
 		surf = self.font.render(chr(unicode_value), False, (255,255,255))
-		size = surf.get_size()
-		num_empty = 0
-		for i in range(size[1]):
-			for j in range(size[0]):
-				num_empty += (surf.get_at((j,i)) == (0, 0, 0, 255))
-		return ((size[0] * size[1]) - num_empty) / (size[0] * size[1])
+		pixels = pygame.surfarray.array3d(surf)
+		num_on = np.count_nonzero(pixels.any(axis=-1))
+		return num_on / (pixels.shape[0] * pixels.shape[1])
 	def is_valid_character(self, unicode_value):
-		percent = self.get_percent_on(unicode_value)
-		return percent > .05 and percent < .5
+		if unicode_value not in self.valid_char_cache:
+			percent = self.get_percent_on(unicode_value)
+			self.valid_char_cache[unicode_value] = percent > .05 and percent < .5
+		return self.valid_char_cache[unicode_value]
 	#interface methods
 	def get_valid_char(self, lower_bound, upper_bound, seed=-1):
 		if seed != -1:
@@ -61,136 +66,138 @@ class Console:
 			char = int((upper_bound - lower_bound) * random.random()) + lower_bound
 		return char
 	def draw_char(self, x, y, char, fore=(255,255,255), back = (0,0,0)):
-		surf = self.font.render(char, False, fore)
+		surf = self.glyph_cache.get((char, fore))
+		if surf is None:
+			surf = self.font.render(char, False, fore)
+			self.glyph_cache[(char, fore)] = surf
 		pygame.draw.rect(self.screen,back,(x * self.scale,y * self.scale, self.scale, self.scale))
 		self.screen.blit(surf, (x * self.scale,y * self.scale))
+	def draw_pixels(self, colours):
+		"""fill every tile with a colour from an (x, y, 3) array in one blit"""
+		surf = pygame.surfarray.make_surface(colours)
+		self.screen.blit(pygame.transform.scale(surf, self.size), (0, 0))
 	def render(self):
 		pygame.display.flip()
 
-class TerrainColumn:
-	def __init__(self, height):
-		self.rock_depth = height
-		self.sediment_depth = 0
-
-	def erode(self, depth):
-		"""erode to a given depth, removing sediment first"""
-		self.sediment_depth -= depth
-		if (self.sediment_depth < 0):
-			self.rock_depth += self.sediment_depth
-			self.sediment_depth = 0
-		if self.rock_depth <= 0:
-			self.rock_depth = 1
-	
-	def deposit(self, depth):
-		self.sediment_depth += depth
-
-	def height(self):
-		"""Return the total height of the column"""
-		return self.rock_depth + self.sediment_depth
-
-	def sediment_to_ascii(self):
-		# if self.sediment_depth < 4:
-		# 	return " "
-		# elif self.sediment_depth < 8:
-		# 	return "`"
-		# elif self.sediment_depth < 12:
-		# 	return "\""
-		# elif self.sediment_depth < 16:
-		# 	return "░"
-		# elif self.sediment_depth < 20:
-		# 	return "▒"
-		# return "▓"
-		return " "
-		
-	def height_to_colour(self):
-		value = self.height()
-		# print(int(255*(value/100)), int(255*(value/100)), int(255*(value/100)))
-		return (max(int(255*min(1, (value/100))), 0), max(int(255*min(1, (value/100))), 0), max(int(255*min(1, (value/100))), 0))
-
-class ErosionDrop:
-	def __init__(self, x, y):
-		self.x = x
-		self.y = y
-		self.sediment = 0
-		self.sediment_capacity = DROP_CAPAC
+@njit(cache=True)
+def _find_downhill_vector_steepness(heights, x, y):
+	"""Return (dx, dy, steepness) of the steepest descent from (x,y)"""
+	if x < 1 or x >= heights.shape[0] - 1 or y < 1 or y >= heights.shape[1] - 1:
+		#if next to border, dont move
+		return 0, 0, 0.0
+	#load the 3x3 neighbourhood, diagonals must be at least DIAGONAL_COST steeper
+	h_nw = heights[x - 1, y - 1]
+	h_n = heights[x - 1, y]
+	h_ne = heights[x - 1, y + 1]
+	h_w = heights[x, y - 1]
+	h_c = heights[x, y]
+	h_e = heights[x, y + 1]
+	h_sw = heights[x + 1, y - 1]
+	h_s = heights[x + 1, y]
+	h_se = heights[x + 1, y + 1]
+	#compare in scan order, keeping the first of equal candidates
+	lowest = h_nw
+	vector_x, vector_y = -1, -1
+	if h_n < lowest:
+		lowest, vector_x, vector_y = h_n, -1, 0
+	if h_ne * DIAGONAL_COST < lowest:
+		lowest, vector_x, vector_y = h_ne, -1, 1
+	if h_w < lowest:
+		lowest, vector_x, vector_y = h_w, 0, -1
+	if h_c < lowest:
+		lowest, vector_x, vector_y = h_c, 0, 0
+	if h_e < lowest:
+		lowest, vector_x, vector_y = h_e, 0, 1
+	if h_sw * DIAGONAL_COST < lowest:
+		lowest, vector_x, vector_y = h_sw, 1, -1
+	if h_s < lowest:
+		lowest, vector_x, vector_y = h_s, 1, 0
+	if h_se * DIAGONAL_COST < lowest:
+		lowest, vector_x, vector_y = h_se, 1, 1
+	return vector_x, vector_y, h_c - lowest
+
+@njit(cache=True)
+def _simulate_erosion_drop(heights, erosion, deposition, x, y, max_path):
+	"""Simulate one raindrop starting at (x,y), accumulating into erosion and deposition"""
+	sediment = 0.0
+	path_length = 0
+	moving = True
+	#path length prevents infinite loops
+	while moving and path_length < max_path:
+		vector_x, vector_y, steepness = _find_downhill_vector_steepness(heights, x, y)
+		#pick up sediment if not at full capacity, deposit sediment otherwise
+		if sediment <= DROP_CAPAC - EROSION_STRENGTH:
+			sediment_taken = ((DROP_CAPAC - sediment)
+							  * EROSION_STRENGTH * steepness**STEEPNESS_COEFF)
+			sediment += sediment_taken
+			erosion[x, y] += sediment_taken
+		elif sediment >= SEDIMENTATION_STRENGTH:
+			sediment -= SEDIMENTATION_STRENGTH
+			deposition[x, y] += SEDIMENTATION_STRENGTH
+		x += vector_x
+		y += vector_y
+		moving = vector_x != 0 or vector_y != 0
+		path_length += 1
+	#drop all remaining sediment where the drop stopped
+	deposition[x, y] += sediment
+
+@njit(parallel=True, cache=True)
+def _simulate_erosion_cycle(heights, erosion, deposition, iterations, num_threads):
+	"""Simulate iterations raindrops across num_threads threads, each starting on a random tile"""
+	max_path = max(heights.shape[0], heights.shape[1])
+	#every thread accumulates into its own meshes so drops never race
+	thread_erosion = np.zeros((num_threads, heights.shape[0], heights.shape[1]), np.float32)
+	thread_deposition = np.zeros((num_threads, heights.shape[0], heights.shape[1]), np.float32)
+	for t in prange(num_threads):
+		#take this thread's views once rather than once per drop
+		erosion_t = thread_erosion[t]
+		deposition_t = thread_deposition[t]
+		for i in range(t, iterations, num_threads):
+			_simulate_erosion_drop(heights, erosion_t, deposition_t,
+								   np.random.randint(heights.shape[0]),
+								   np.random.randint(heights.shape[1]),
+								   max_path)
+	for t in range(num_threads):
+		erosion += thread_erosion[t]
+		deposition += thread_deposition[t]
 
 class MapGen:
-	def noise_octaves(self, x, y, additional_octaves = 0, pers = 2):
-		value = self.gen.noise2d(x, y)
+	def noise_octaves(self, xs, ys, additional_octaves = 0, pers = 2):
+		"""return the noise over the grid spanned by xs and ys, indexed [x, y]"""
+		#noise2array is indexed [y, x]
+		value = self.gen.noise2array(xs, ys).T
 		max_value = 1
 		for i in range(additional_octaves):
 			amp = (1/(pers**i))
-			value += amp*self.gen.noise2d(x*(2**i), y*(2**i))
+			value += amp*self.gen.noise2array(xs*(2**i), ys*(2**i)).T
 			max_value += amp
 		return value/max_value
 
 	def __init__(self, seed, x, y):
 		self.console = Console(x, y, 8)
 		self.gen = OpenSimplex(seed=seed)
-		self.map = np.ndarray((x, y), dtype=TerrainColumn)
-		for i in range(self.map.shape[0]):
-			for j in range(self.map.shape[1]):
-				self.map[i, j] = TerrainColumn(int(self.noise_octaves(i/10, j/10, 0)*30 + 40))
-
-	def find_downhill_vector_steepness(self, x, y):
-		lowest = 1000000
-		vector = (0,0)
-		for i in range(-1, 2):
-			for j in range(-1, 2):
-				if ((x + i < 0 or x + i >= self.map.shape[0]) 
-					or (y + j < 0 or y + j >= self.map.shape[1])):
-					#if next to border, dont move
-					return [(0,0), 0]
-				current_height = self.map[x + i, y + j].height()
-				if (i != 0 and j != 0):
-					#must be at least 1 = 0
-					# continue
-					current_height *= 1.4
-				if current_height < lowest:
-					lowest = self.map[x + i, y + j].height()
-					vector = (i,j)
-		return [vector, self.map[x, y].height() - lowest]
-
-	def handle_sediment(self, drop, erosion_mesh, steepness):
-		"""pick up sediment if not at full capacity, deposit sediment otherwise"""
-		if drop.sediment <= drop.sediment_capacity - EROSION_STRENGTH:
-			sediment_taken = ((drop.sediment_capacity - drop.sediment) 
-							  * EROSION_STRENGTH * steepness**STEEPNESS_COEFF)
-			drop.sediment += sediment_taken
-			erosion_mesh[drop.x, drop.y, 0] += sediment_taken
-		elif drop.sediment >= SEDIMENTATION_STRENGTH:
-			drop.sediment -= SEDIMENTATION_STRENGTH
-			erosion_mesh[drop.x, drop.y, 1] += SEDIMENTATION_STRENGTH
-			
-	def drop_all_sediment(self, drop, erosion_mesh):
-		erosion_mesh[drop.x, drop.y, 1] += drop.sediment#/1.5
-		drop.sediment = 0
-
-	def simulate_erosion_drop(self, x, y, erosion_mesh):
-		drop = ErosionDrop(x, y)
-		vector = (-1, -1)
-		path_length = 0
-		while (vector != (0,0) and 
-				path_length < max(erosion_mesh.shape[0], erosion_mesh.shape[1])):
-			#path length prevents infinite loops
-			vs = self.find_downhill_vector_steepness(drop.x, drop.y)
-			vector = vs[0]
-			steepness = vs[1]
-			self.handle_sediment(drop, erosion_mesh, steepness)
-			drop.x += vector[0]
-			drop.y += vector[1]
-		self.drop_all_sediment(drop, erosion_mesh)
+		#the terrain is stored as two parallel arrays: rock and sediment depth
+		field = self.noise_octaves(np.arange(x)/10, np.arange(y)/10, 0)
+		self.rock = np.trunc(field*30 + 40).astype(np.float32)
+		self.sediment = np.zeros_like(self.rock)
+
+	def erode(self, erosion, deposition):
+		"""erode every column by erosion, removing sediment first, then deposit deposition"""
+		self.sediment -= erosion
+		#sediment below 0 means the erosion reached the rock
+		self.rock += np.minimum(self.sediment, 0)
+		np.maximum(self.sediment, 0, out=self.sediment)
+		self.rock[self.rock <= 0] = 1
+		self.sediment += np.minimum(MAX_SED_PER_TILE, deposition)
 
 	def erosion_cycle(self, iterations):
-		erosion_mesh = np.zeros((self.map.shape[0], self.map.shape[1], 2))
-		for i in range(iterations):
-			self.simulate_erosion_drop(int(random.random() * self.map.shape[0]),
-									   int(random.random() * self.map.shape[1]),
-									   erosion_mesh)
-		for i in range(self.map.shape[0]):
-			for j in range(self.map.shape[1]):
-				self.map[i, j].erode(erosion_mesh[i,j, 0])
-				self.map[i, j].deposit(min(MAX_SED_PER_TILE, erosion_mesh[i,j, 1]))
+		#total depth eroded and deposited on each tile during this cycle
+		erosion = np.zeros_like(self.rock)
+		deposition = np.zeros_like(self.rock)
+		#heights only change once the whole cycle has been simulated
+		_simulate_erosion_cycle(self.rock + self.sediment, erosion, deposition,
+								iterations, get_num_threads())
+		self.erode(erosion, deposition)
 
 	def erode_landscape(self, cycles, iterations_per_cycle):
 		for i in range(cycles):
@@ -201,9 +208,9 @@ class MapGen:
 				if event.type == pygame.QUIT: return
 
 	def print_self(self):
-		for i in range(self.map.shape[0]):
-			for j in range(self.map.shape[1]):
-				self.console.draw_char(i, j, self.map[i, j].sediment_to_ascii(), fore=(255,0,0), back=self.map[i, j].height_to_colour())
+		#only the background colour of each tile varies, so draw it as pixels
+		shade = (255*np.clip((self.rock + self.sediment)/100, 0, 1)).astype(np.uint8)
+		self.console.draw_pixels(np.stack((shade, shade, shade), axis=-1))
 		self.console.render()
 
 g = MapGen(int(random.random()*1000000), 50, 50)
@@ -9,13 +9,14 @@
 import math
 import random
 from time import sleep
-from itertools import combinations
 
+import numpy as np
 import pygame
 
 GRAV_CONST = 1.5    #gravitational constant, G, for the simulation
 MIN_DIST = .0001    #the minimum distance or radius, to stop divide by 0
 PLANET_SIZE_COEFF = 10 #the coefficient for planet sizes
+BATCH_DRAW_THRESHOLD = 100 #object count above which circles are rasterized in numpy
 
 class PhysicsObject:
     """
@@ -28,9 +29,8 @@ class PhysicsObject:
     vel-- the current velocity of the object in component form, 
           as a tuple of floats (x,y).
 
-    Public Methods:
-    apply_force()
-    move()
+    Once added to a World, the object is simulated in the World's arrays
+    and pos and vel keep their starting values, except for the ship.
     """
 
     def __init__(self, mass, pos, radius=100.0, vel=(0.0,0.0)):
@@ -50,21 +50,6 @@ class PhysicsObject:
         self.pos = pos
         self.vel = vel
 
-    def apply_force(self, force): #force must be given in (x,y)
-        """Apply a force on the object and thus accelerate it.
-        
-        Keyword arguments:
-        force-- the force applied in component form, 
-                as a tuple of floats (x,y)
-        """
-        self.vel = (self.vel[0] + (force[0] / self.mass), 
-                    self.vel[1] + (force[1] / self.mass))
-
-    def move(self):
-        """Move the object based on current velocity."""
-        self.pos = (self.pos[0] + self.vel[0], 
-                    self.pos[1] + self.vel[1])
-
 
 class Planet(PhysicsObject):
     """
@@ -78,21 +63,14 @@ class Planet(PhysicsObject):
 
 
 class Propulsive(PhysicsObject):
+    """
+    Child class of PhysicsObject, accelerated every tick by its thrust.
+    """
+
     def __init__(self, mass, pos, radius=100.0, vel=(0.0,0.0)):
         super().__init__(mass, pos, radius, vel)
         self.thrust = (0.0, 0.0)
     
-    def move(self):
-        """
-        Accelerate from thrust, then move
-        
-        Overriding the PhysicsObject move() method
-        """
-        self.vel = (self.vel[0] + (self.thrust[0] / self.mass), 
-                    self.vel[1] + (self.thrust[1] / self.mass))
-        self.pos = (self.pos[0] + self.vel[0], 
-                    self.pos[1] + self.vel[1])
-
     def accx(self, amount):
         """accelerate along the x axis"""
         self.thrust = (self.thrust[0] + amount, self.thrust[1])
@@ -105,104 +83,147 @@ class World:
     """
     Contains PhysicsObjects and handles their interactions
 
+    The simulation runs on parallel arrays indexed like objects. Only the
+    ship's position and velocity are copied back to it every tick.
+
     Instance Variables:
     objects-- stores a list of PhysicsObjects
+    mass-- the masses of the objects, as an array of shape (N,)
+    radius-- the radii of the objects, as an array of shape (N,)
+    pos-- the positions of the objects, as an array of shape (N,2)
+    vel-- the velocities of the objects, as an array of shape (N,2)
+    ship-- the player's Propulsive object
+    ship_index-- the index of the ship, None once it has collided
 
     Public Methods:
     simulate_tick()
     """
 
     def __init__(self):
-        self.objects = [
+        self.objects = []
+        self.mass = np.empty(0)
+        self.radius = np.empty(0)
+        self.pos = np.empty((0, 2))
+        self.vel = np.empty((0, 2))
+        for physobj in [
                         Propulsive(.001, (1000, 2000), 10, (.6, 0.0)),
                         Planet(1000.0, (1000.0,1000.0), (0.6, 0.1)), Planet(10, (2000.0,1000.0), (0.0, .30)),
                         Planet(1000.0, (5000.0,1000.0), (-0.6, 0.1))
-                        ]
+                        ]:
+            self._add_object(physobj)
         self.ship = self.objects[0]
-        pass
+        self.ship_index = 0
 
     def _add_object(self, physobj):
         """Add the PhysicsObject physobj to self.objects"""
         self.objects.append(physobj)
+        self.mass = np.append(self.mass, physobj.mass)
+        self.radius = np.append(self.radius, physobj.radius)
+        self.pos = np.vstack((self.pos, physobj.pos))
+        self.vel = np.vstack((self.vel, physobj.vel))
 
-    def _distance(self, pos1, pos2):
-        """Return distance of two coordinate points in format (x,y)"""
-        return math.sqrt((pos1[0] - pos2[0])**2 + (pos1[1] - pos2[1])**2)
+    def _remove_objects(self, indices):
+        """Remove the objects at the given indices from self.objects"""
+        keep = np.ones(len(self.objects), dtype=bool)
+        keep[list(indices)] = False
+        self.objects = [obj for obj, kept in zip(self.objects, keep) if kept]
+        self.mass = self.mass[keep]
+        self.radius = self.radius[keep]
+        self.pos = self.pos[keep]
+        self.vel = self.vel[keep]
+        if self.ship_index is not None:
+            #the ship is gone if it collided, otherwise it moves down
+            self.ship_index = (int(np.count_nonzero(keep[:self.ship_index]))
+                               if keep[self.ship_index] else None)
 
-    def _mutual_force(self, object1, object2, force):
-        """
-        Apply equal and opposite attractive forces between two PhysicsObjects.
-        
-        Keyword arguments:
-        object1-- the first PhysicsObject
-        object2-- the second PhysicsObject
-        force-- the magnitude of the force, as a float, 
-                with positive defined as pulling the objects together
-        """
-        distance = self._distance(object1.pos, object2.pos)
-        if distance == 0: distance = MIN_DIST
-        coeff = force/distance
-        #this is the force applied on object2, in component form.
-        force_components = ((object1.pos[0] - object2.pos[0]) * coeff,
-                            (object1.pos[1] - object2.pos[1]) * coeff)
-        # apply the forces (note that the force on object1 is 
-        # equal and opposite to the force on object2)
-        object2.apply_force(force_components)
-        object1.apply_force((-force_components[0], -force_components[1]))
-    
-    def _apply_gravitational_force(self, object1, object2):
-        """
-        Calculate and apply the gravitational force between two objects
-        
-        Keyword arguments:
-        object1-- the first PhysicsObject
-        object2-- the second PhysicsObject
-        """
-        # F = G(m1*m2)/r^2
-        radius = self._distance(object1.pos, object2.pos)
-        if radius == 0: radius = MIN_DIST #stop div by 0 crashes
-        force = GRAV_CONST * (object1.mass * object2.mass) / (radius)**2
-        self._mutual_force(object1, object2, force)
-
-    def _are_touching(self, object1, object2):
-        """Return whether or not two objects are touching"""
-        total_r = object1.radius + object2.radius
-        return self._distance(object1.pos, object2.pos) <= total_r
-    
-    def _simulate_sticky_collision(self, obj1, obj2):
+    def _dist_sq(self, pos1, pos2):
+        """Return squared distance of two coordinate points in format (x,y)"""
+        return (pos1[0] - pos2[0])**2 + (pos1[1] - pos2[1])**2
+
+    def _apply_gravitational_forces(self):
+        """Calculate and apply the gravitational forces between all objects"""
+        # F = G(m1*m2)/r^2, so object1 accelerates by G*m2/r^2 towards object2
+        offsets = self.pos[np.newaxis, :, :] - self.pos[:, np.newaxis, :]
+        radius_sq = (offsets**2).sum(axis=-1)
+        radius_sq[radius_sq == 0] = MIN_DIST**2 #stop div by 0 crashes
+        # divide by r once more to scale the offsets to unit vectors
+        coeff = GRAV_CONST * self.mass[np.newaxis, :] / (radius_sq * np.sqrt(radius_sq))
+        np.fill_diagonal(coeff, 0)
+        self.vel += (offsets * coeff[:, :, np.newaxis]).sum(axis=1)
+
+    def _are_touching(self, i, j):
+        """Return whether or not the objects at indices i and j are touching"""
+        total_r = self.radius[i] + self.radius[j]
+        return self._dist_sq(self.pos[i], self.pos[j]) <= total_r**2
+
+    def _simulate_sticky_collision(self, i, j):
         """
-        Simulate a sticky collision, replacing two objects with one
-        
+        Simulate a sticky collision, returning the object replacing two
+
         Keyword arguments:
-        obj1-- the first PhysicsObject involved in the collision
-        obj2-- the second PhysicsObject involved in the collision
+        i-- the index of the first object involved in the collision
+        j-- the index of the second object involved in the collision
         """
         #conserve mass and area
-        new_radius = math.sqrt((obj1.radius)**2 + (obj2.radius)**2)
-        new_mass = obj1.mass + obj2.mass
+        new_radius = math.sqrt((self.radius[i])**2 + (self.radius[j])**2)
+        new_mass = self.mass[i] + self.mass[j]
         #positioned is average weighed (heh) by mass
-        new_pos = ((obj1.pos[0]*obj1.mass + obj2.pos[0]*obj2.mass)/(new_mass),
-                   (obj1.pos[1]*obj1.mass + obj2.pos[1]*obj2.mass)/(new_mass))
-        #calculate the new velocity using momentum (split into x and y for clarity)
-        vx = (obj1.vel[0]*obj1.mass + obj2.vel[0]*obj2.mass)/new_mass
-        vy = (obj1.vel[1]*obj1.mass + obj2.vel[1]*obj2.mass)/new_mass
-        new_vel = (vx, vy)
-        #delete the two objects, create new one in its place
-        self.objects.remove(obj1)
-        self.objects.remove(obj2)
-        self._add_object(PhysicsObject(new_mass, new_pos, new_radius, new_vel))
-        print("collision between", obj1, obj2)
+        new_pos = tuple((self.pos[i]*self.mass[i] + self.pos[j]*self.mass[j])/new_mass)
+        #calculate the new velocity using momentum
+        new_vel = tuple((self.vel[i]*self.mass[i] + self.vel[j]*self.mass[j])/new_mass)
+        print("collision between", self.objects[i], self.objects[j])
+        return PhysicsObject(new_mass, new_pos, new_radius, new_vel)
+
+    def _broad_phase_pairs(self):
+        """
+        Return the index pairs of objects that may be touching.
+
+        Objects are hashed into a uniform grid with cells as wide as the
+        largest diameter, so touching objects always share a cell or sit
+        in neighbouring cells and only those pairs need a precise test.
+        """
+        if len(self.objects) < 2:
+            return []
+        cell_size = max(2 * self.radius.max(), MIN_DIST)
+        cells = np.floor(self.pos / cell_size).astype(int)
+        grid = {}
+        for index, cell in enumerate(map(tuple, cells.tolist())):
+            grid.setdefault(cell, []).append(index)
+        pairs = []
+        for (cellx, celly), members in grid.items():
+            for dx in range(-1, 2):
+                for dy in range(-1, 2):
+                    for j in grid.get((cellx + dx, celly + dy), ()):
+                        #each pair is only produced from its lower index
+                        pairs.extend((i, j) for i in members if i < j)
+        return pairs
 
     def simulate_tick(self):
         """Simulate a single tick of physics simulation"""
-        #first move all objects
-        for i in self.objects:
-            i.move()
-        #then have all pairs of objects interact
-        for pair in combinations(self.objects, 2):
-            if self._are_touching(pair[0], pair[1]):
-                self._simulate_sticky_collision(pair[0], pair[1])
-            self._apply_gravitational_force(pair[0], pair[1])
+        #first accelerate the ship from thrust and move all objects
+        if self.ship_index is not None:
+            self.vel[self.ship_index, 0] += self.ship.thrust[0] / self.mass[self.ship_index]
+            self.vel[self.ship_index, 1] += self.ship.thrust[1] / self.mass[self.ship_index]
+        self.pos += self.vel
+        #then collide touching objects, each object collides at most once
+        collided = set()
+        merged = []
+        for i, j in sorted(self._broad_phase_pairs()):
+            if i in collided or j in collided:
+                continue
+            if self._are_touching(i, j):
+                collided.update((i, j))
+                merged.append(self._simulate_sticky_collision(i, j))
+        if collided:
+            self._remove_objects(collided)
+            for physobj in merged:
+                self._add_object(physobj)
+        #then have all pairs of objects attract
+        self._apply_gravitational_forces()
+        #the ship is the only object read outside the world, for the camera
+        if self.ship_index is not None:
+            self.ship.pos = tuple(self.pos[self.ship_index].tolist())
+            self.ship.vel = tuple(self.vel[self.ship_index].tolist())
 
 
 class SimulationHandler:
@@ -216,6 +237,7 @@ class SimulationHandler:
         self.run = True
         self.camx = 0
         self.camy = 0
+        self.circle_stamps = {}
 
     def get_colour_of_obj(self, obj):
         if isinstance(obj, Planet):
@@ -224,6 +246,49 @@ class SimulationHandler:
             return (255, 0, 0)
         return (128, 100, 128)
 
+    def get_circle_stamp(self, radius):
+        """Return the pixel offsets (dx, dy) that pygame.draw.circle fills"""
+        if radius not in self.circle_stamps:
+            #draw the circle once with pygame so the footprint matches exactly
+            centre = radius + 1
+            surf = pygame.Surface((2*centre + 1, 2*centre + 1))
+            pygame.draw.circle(surf, (255, 255, 255), (centre, centre), radius, 0)
+            dx, dy = np.nonzero(pygame.surfarray.array3d(surf)[..., 0])
+            self.circle_stamps[radius] = (dx - centre, dy - centre)
+        return self.circle_stamps[radius]
+
+    def draw_objects(self):
+        """Draw every object, rasterizing in numpy when there are many"""
+        xs = (self.world.pos[:, 0] / 10 + self.camx).astype(int)
+        ys = (self.world.pos[:, 1] / 10 + self.camy).astype(int)
+        radii = np.maximum((self.world.radius / 10).astype(int), 1)
+        colours = [self.get_colour_of_obj(i) for i in self.world.objects]
+        if len(colours) <= BATCH_DRAW_THRESHOLD:
+            for x, y, radius, colour in zip(xs.tolist(), ys.tolist(),
+                                            radii.tolist(), colours):
+                pygame.draw.circle(self.screen, colour, (x, y), radius, 0)
+            return
+        colours = np.array(colours, dtype=np.uint8)
+        #stamp all circles of the same radius in one go
+        px, py, owner = [], [], []
+        for radius in np.unique(radii).tolist():
+            same_radius = np.flatnonzero(radii == radius)
+            dx, dy = self.get_circle_stamp(radius)
+            px.append((xs[same_radius, np.newaxis] + dx).ravel())
+            py.append((ys[same_radius, np.newaxis] + dy).ravel())
+            owner.append(np.repeat(same_radius, dx.shape[0]))
+        px, py, owner = np.concatenate(px), np.concatenate(py), np.concatenate(owner)
+        on_screen = (px >= 0) & (px < self.width) & (py >= 0) & (py < self.height)
+        px, py, owner = px[on_screen], py[on_screen], owner[on_screen]
+        #where circles overlap, the last object wins as in the per-object loop
+        order = np.argsort(owner, kind='stable')[::-1]
+        _, last = np.unique(px[order] * self.height + py[order], return_index=True)
+        drawn = order[last]
+        pixels = pygame.surfarray.pixels3d(self.screen)
+        pixels[px[drawn], py[drawn]] = colours[owner[drawn]]
+        #release the lock that pixels3d holds on the screen
+        del pixels
+
     def go(self):
         while self.run:
             for event in pygame.event.get():
@@ -250,10 +315,7 @@ class SimulationHandler:
             self.camy = self.height/2 - self.world.ship.pos[1]/10
             # print(self.camx, self.camy)
             self.screen.fill((0,0,0))
-            for i in self.world.objects:
-                pygame.draw.circle(self.screen, self.get_colour_of_obj(i), 
-                    (int(i.pos[0] / 10 + self.camx), int(i.pos[1] / 10 + self.camy)), 
-                    max(int(i.radius / 10), 1), 0)
+            self.draw_objects()
             pygame.display.flip()
             sleep(.01)
             self.world.simulate_tick()
@@ -11,6 +11,7 @@ from time import sleep
 
 import numpy as np
 import noise
+from opensimplex import OpenSimplex
 import curses
 
 random.seed()
@@ -20,10 +21,12 @@ GROUND_LEVEL = 8	#the base ground level
 GROUND_HEIGHT = 30
 GROUND_SCALE = .02
 CAVE_SCALE = .03
-CAVE_WIDTH = .15
+CAVE_WIDTH = .075
 ORE_SCALE = .1
-ORE_THRESHOLD = .7
+ORE_THRESHOLD = .66
 WATER_LEVEL = 8
+RENDER_DISTANCE = 3	#how many chunks are kept loaded around the player
+WALKABLE_BLOCKS = (0, 2, 4)	#blocks the player can move through without gravity
 
 class Chunk:
 	def val_to_ascii(self, val):
@@ -42,26 +45,43 @@ class Chunk:
 		return '?'		#unknown block
 
 	def __init__(self, x, y, gen):
-		self.blocks = np.zeros((CHUNK_SIZE, CHUNK_SIZE))
 		self.x = x
 		self.y = y
 		self.modified = False
-		for in_y in range(0, self.blocks.shape[1]):
-			for in_x in range(0, self.blocks.shape[0]):
-				self.blocks[in_x, in_y] = gen(in_x + (self.x*16), 
-											  in_y + (self.y*16))
-				if (in_y > 0 and self.blocks[in_x, in_y - 1] == 0 
-					and (self.blocks[in_x, in_y] == 1)):
-					#if below air and is stone, turn to grass
-					self.blocks[in_x, in_y] = 5	#grass
+		#world coordinates of the blocks in this chunk
+		xs = np.arange(CHUNK_SIZE) + self.x*16
+		ys = np.arange(CHUNK_SIZE) + self.y*16
+		self.blocks = gen(xs, ys)
+		#if below air and is stone, turn to grass
+		grass = (self.blocks[:, :-1] == 0) & (self.blocks[:, 1:] == 1)
+		self.blocks[:, 1:][grass] = 5
+		self.update_render_cache()
+		#the first non-walkable y of each column, used for climbing
+		self.update_surface()
+
+	def update_render_cache(self):
+		"""precompute the runs of identical blocks in each row for render"""
+		self.runs = []
+		for y in range(0, self.blocks.shape[1]):
+			row = self.blocks[:, y]
+			#a run starts wherever the block differs from the one before it
+			starts = np.flatnonzero(np.diff(row, prepend=-1))
+			ends = np.append(starts[1:], row.shape[0])
+			self.runs.append([(start, self.val_to_ascii(row[start]) * (end - start), row[start])
+							  for start, end in zip(starts, ends)])
+
+	def update_surface(self):
+		"""recompute the first non-walkable y of each column, CHUNK_SIZE if none"""
+		solid = ~np.isin(self.blocks, WALKABLE_BLOCKS)
+		self.surface_y = np.where(solid.any(axis=1), solid.argmax(axis=1), CHUNK_SIZE)
 
 	def render(self, camerax, cameray, offsetx, offsety, drawfunc):
-		for y in range(0, self.blocks.shape[1]):
-			for x in range(0, self.blocks.shape[0]):
-				drawy = y - cameray + offsety + self.y*16
-				drawx = x - camerax + offsetx + self.x*16
-				val = self.blocks[x, y]
-				drawfunc(drawy, drawx, self.val_to_ascii(val), val)
+		"""draw the chunk, one call per run of identical blocks in a row"""
+		for y, row_runs in enumerate(self.runs):
+			drawy = y - cameray + offsety + self.y*16
+			for start, string, val in row_runs:
+				drawx = start - camerax + offsetx + self.x*16
+				drawfunc(drawy, drawx, string, val)
 				
 
 class Display:
@@ -84,84 +104,120 @@ class Display:
 
 		#set the seed
 		self.seed = random.random() * 100000000
-		#create the dictionary of chunks
-		self.chunks = {}
-		self.chunks_to_unload = []
+		self.gen = OpenSimplex(seed=int(self.seed))
+		#ground levels of the columns in the window, keyed by x
+		self.ground_levels = {}
+		#create the window of loaded chunks, centered on the chunk at origin
+		size = 2*RENDER_DISTANCE + 1
+		self.window = np.empty((size, size), dtype=object)
+		self.origin = (0, 0)
 		self.playerx = 0
 		self.playery = 0
-		for x in range(-3, 3):
-			for y in range(-3, 3):
-				self.add_chunk(x,y)
-
-	def chunk_generator(self, x, y):
-		"""Determine the terrain for a given coordinate. Passed to chunks."""
-		ground_level = ((GROUND_HEIGHT 
-						* noise.snoise2(x*GROUND_SCALE, self.seed, 5))
-						+ GROUND_LEVEL)
-		cave_value = noise.snoise3(x*CAVE_SCALE, y*CAVE_SCALE, self.seed)
-		ore_value = noise.snoise3(x*ORE_SCALE, y*ORE_SCALE, self.seed)
-		# print(ground_level)
-		if y < ground_level:
-			if (y < WATER_LEVEL):
-				return 0	#sky
-			return 4	#water
-		if cave_value < .5 + CAVE_WIDTH and cave_value > .5 - CAVE_WIDTH:
-			return 2	#cave air
-		if ore_value > ORE_THRESHOLD:
-			return 3	#ore
-		return 1	#rock
+		for i in range(size):
+			for j in range(size):
+				self.add_chunk(i, j)
+
+	def ground_level(self, x):
+		"""Return the ground level of world column x, computed once per column."""
+		x = int(x)
+		if x not in self.ground_levels:
+			self.ground_levels[x] = ((GROUND_HEIGHT
+									  * noise.snoise2(x*GROUND_SCALE, self.seed, 5))
+									 + GROUND_LEVEL)
+		return self.ground_levels[x]
+
+	def chunk_generator(self, xs, ys):
+		"""Determine the terrain for a grid of coordinates. Passed to chunks."""
+		ground_level = np.array([self.ground_level(x) for x in xs])
+		#the noise arrays are indexed [y, x], the chunks [x, y]
+		cave_value = self.gen.noise2array(xs*CAVE_SCALE, ys*CAVE_SCALE).T
+		ore_value = self.gen.noise2array(xs*ORE_SCALE, ys*ORE_SCALE).T
+		blocks = np.ones((xs.shape[0], ys.shape[0]))	#rock
+		blocks[ore_value > ORE_THRESHOLD] = 3	#ore
+		blocks[np.abs(cave_value - .5) < CAVE_WIDTH] = 2	#cave air
+		above_ground = ys[np.newaxis, :] < ground_level[:, np.newaxis]
+		sky = np.broadcast_to(ys < WATER_LEVEL, blocks.shape)
+		blocks[above_ground & sky] = 0	#sky
+		blocks[above_ground & ~sky] = 4	#water
+		return blocks
 
 	def is_passable_block(self, blockID, gravity):
-		return blockID == 0 or ((not gravity) and blockID == 4) or blockID == 2
-
-	def add_chunk(self, x, y):
-		"""Add a chunk to the dictionary."""
-		self.chunks[(x,y)] = Chunk(x,y, self.chunk_generator)
-
-	def addch_wrapper(self, y, x, char, colour):
-		"""A wrapper for addch that is passed to chunks for rendering"""
-		if ((x < 1 or x >= curses.COLS - 1)
-			or (y < 1 or y >= curses.LINES - 1)):
-			#if either x or y are out of bounds, do nothing
+		#water can be swum through, but the player does not sink in it
+		return blockID in WALKABLE_BLOCKS and not (gravity and blockID == 4)
+
+	def add_chunk(self, i, j):
+		"""Generate the chunk belonging in cell (i,j) of the window."""
+		x = self.origin[0] + i - RENDER_DISTANCE
+		y = self.origin[1] + j - RENDER_DISTANCE
+		self.window[i, j] = Chunk(x, y, self.chunk_generator)
+
+	def get_chunk(self, x, y):
+		"""Return the chunk at chunk coordinates (x,y), loading around it if needed."""
+		i = x - self.origin[0] + RENDER_DISTANCE
+		j = y - self.origin[1] + RENDER_DISTANCE
+		if not (0 <= i < self.window.shape[0] and 0 <= j < self.window.shape[1]):
+			self.handle_chunk_loading(x*16, y*16)
+			i = j = RENDER_DISTANCE
+		return self.window[i, j]
+
+	def addstr_wrapper(self, y, x, string, colour):
+		"""A wrapper for addstr that is passed to chunks for rendering"""
+		if y < 1 or y >= curses.LINES - 1:
+			#if y is out of bounds, do nothing
 			return
-		self.stdscr.addch(int(y), int(x), char, curses.color_pair(int(colour) + 1))
-
-	def kings_distance(self, x1, y1, x2, y2):
-		"""return taxicab distance between two points"""
-		return max(abs(x1 - x2), abs(y1 - y2))
+		#clip the string to the columns that are in bounds
+		start = max(1 - x, 0)
+		end = min(curses.COLS - 1 - x, len(string))
+		if start >= end:
+			return
+		self.stdscr.addstr(int(y), int(x + start), string[start:end],
+						   curses.color_pair(int(colour) + 1))
 
 	def render(self, x, y, offsetx, offsety):
 		"""render terrain centered around (x,y), offset by (offsetx,offsety)"""
 		self.stdscr.clear()
-		for i in self.chunks.values():
-			i.render(x, y, offsetx, offsety, self.addch_wrapper)
-		self.addch_wrapper(offsety, offsetx, '@', 2)
+		for i in self.window.flat:
+			i.render(x, y, offsetx, offsety, self.addstr_wrapper)
+		self.addstr_wrapper(offsety, offsetx, '@', 2)
 		self.stdscr.addstr(0, 0, "meenman v0.1 [q] to quit")
 		self.stdscr.refresh()
 
-	def handle_chunk_loading(self, x, y, render_distance):
-		#unload far away chunks
-		for i in self.chunks.values():
-			if self.kings_distance(x / 16, y / 16, i.x, i.y) > render_distance:
-				self.chunks_to_unload.append(i)
-		while len(self.chunks_to_unload) != 0:
-			del self.chunks[(self.chunks_to_unload[-1].x, 
-							 self.chunks_to_unload[-1].y)]
-			del self.chunks_to_unload[-1]
-		for i in range(-render_distance, render_distance):
-			for j in range(-render_distance, render_distance):
-				if not self.chunks.__contains__((int(x/16) + j, int(y/16) + i)):
-					self.add_chunk(int(x/16) + j, int(y/16) + i)
+	def handle_chunk_loading(self, x, y):
+		"""keep the window of loaded chunks centered on the chunk containing (x,y)"""
+		shiftx = x // 16 - self.origin[0]
+		shifty = y // 16 - self.origin[1]
+		if shiftx == 0 and shifty == 0:
+			return
+		self.origin = (x // 16, y // 16)
+		#move the chunks that stay loaded to their new cells
+		self.window = np.roll(self.window, (-shiftx, -shifty), axis=(0, 1))
+		if shiftx != 0:
+			#forget the ground levels of columns that left the window
+			low = (self.origin[0] - RENDER_DISTANCE) * 16
+			high = (self.origin[0] + RENDER_DISTANCE + 1) * 16
+			self.ground_levels = {column: level for column, level in self.ground_levels.items()
+								  if low <= column < high}
+		#then generate the cells that were rolled around from the far side
+		size = self.window.shape[0]
+		for i in range(size):
+			for j in range(size):
+				if not (0 <= i + shiftx < size and 0 <= j + shifty < size):
+					self.add_chunk(i, j)
 
 	def move_player(self, x, y, g=False):
-		chunk = self.chunks[((self.playerx+x) // 16, (self.playery+y) // 16)]
+		chunk = self.get_chunk((self.playerx+x) // 16, (self.playery+y) // 16)
 		internal_x = (self.playerx + x) % 16
 		internal_y = (self.playery + y) % 16
 		if self.is_passable_block(chunk.blocks[internal_x, internal_y], g):
 			self.playerx += x
 			self.playery += y
 		elif x != 0 and y == 0:	#if moving horizontally and hitting wall, try climb
-			self.move_player(x, -1)
+			if 0 < internal_y == chunk.surface_y[internal_x]:
+				#the wall is the top of its column, so the square above is open
+				self.playerx += x
+				self.playery -= 1
+			else:
+				self.move_player(x, -1)
 
 	def loop(self):
 		run = True
@@ -181,7 +237,7 @@ class Display:
 				if key == curses.KEY_DOWN:
 					self.move_player(0, 1)
 				key = self.stdscr.getch()
-			self.handle_chunk_loading(self.playerx, self.playery, 3)
+			self.handle_chunk_loading(self.playerx, self.playery)
 			self.render(self.playerx, self.playery, curses.COLS//2, curses.LINES//2)
 
 	def __del__(self):